@@ -7,31 +7,61 @@ import numpy as np
 import pandas as pd
 import copy
 import os
+import hashlib
+import functools
+from collections import OrderedDict
 import re
-import rasterio
-import geopandas
-import rasterio.plot
-import rioxarray
-from shapely.geometry import mapping, Polygon
 import calendar
-import statsmodels.api as sm
 import datetime as dt
 import scipy.stats as ss
 from glob import glob
-import xesmf as xe
-from pyproj import Transformer, CRS, transform, Proj
-from sklearn.neighbors import BallTree
+from pyproj import Transformer
+from joblib import Parallel, delayed
 
 
 ########
 #Defining functions
 
+########
+#Data arrays returned by the cookbook are kept in memory (as lazy arrays), so repeated requests for the same data do not query the database or open files again
+_getvar_cache = OrderedDict()
+_getvar_cache_size = 16
+
+#Loads data using `cc.querying.getvar()`, reusing results from previous calls with the same inputs
+def getvar_cached(exp, var, ses, **kwargs):
+    '''
+    Inputs:
+    exp - Experiment name
+    var - Short name for the variable of interest
+    ses - Cookbook session
+    Optional:
+    Any other inputs accepted by `cc.querying.getvar()` (e.g., frequency, start_time, end_time, n, chunks)
+    
+    Output:
+    Data array returned by `cc.querying.getvar()`
+    '''
+    #Inputs are turned into text so unhashable values (e.g., chunks dictionary) can be used to identify requests
+    key = (exp, var, ses, repr(sorted(kwargs.items())))
+    vararray = _getvar_cache.get(key)
+    if vararray is None:
+        vararray = cc.querying.getvar(exp, var, ses, **kwargs)
+        _getvar_cache[key] = vararray
+        #Remove least recently used data array if cache is full
+        if len(_getvar_cache) > _getvar_cache_size:
+            _getvar_cache.popitem(last = False)
+    else:
+        #Mark data array as most recently used
+        _getvar_cache.move_to_end(key)
+    #Shallow copy ensures changes to coordinates do not affect cached data array
+    return vararray.copy(deep = False)
+
+
 ########
 #Loads ACCESS-OM2-01 sea ice and ocean data for the Southern Ocean. If ice data is accessed, it corrects the time and coordinate grid to match ocean outputs.
 def getACCESSdata_SO(var, start, end, freq, ses, minlat = -90, maxlat = -45, 
-                  exp = '01deg_jra55v140_iaf_cycle4', ice_data = False):
+                  exp = '01deg_jra55v140_iaf_cycle4', ice_data = False, chunks = None):
     '''
-    Defining function that loads data automatically using `cc.querying.getvar()` in a loop. The inputs needed are similar to those for the `cc.querying.getvar()` function, with the addition of inputs to define an area of interest.  
+    Defining function that loads data automatically using `cc.querying.getvar()` in a loop (results are reused if the same data is requested again). The inputs needed are similar to those for the `cc.querying.getvar()` function, with the addition of inputs to define an area of interest.  
 The `getACCESSdata` will achieve the following:  
 - Access data for the experiment and variable of interest at the frequency requested and within the time frame specified  
 - Apply **time corrections** as midnight (00:00:00) is interpreted differently by the CICE model and the xarray package.
@@ -49,30 +79,33 @@ The `getACCESSdata` will achieve the following:
     maxlat - maximum latitude from which to return data. If not set, defaults to -45 to cover the Southern Ocean.
     exp - Experiment name. Default is 01deg_jra55v140_iaf_cycle4.
     ice_data - Boolean, when True the variable being called is related to sea ice, when False is not. Default is set to False (i.e., it assumes variable is related to the ocean).
+    chunks - Dictionary with chunk sizes used to load data lazily (e.g., {'time': 1}). Dimension names must match those in the original files (i.e., ni and nj for sea ice data). If not set, chunks defined by the cookbook are used.
         
     Output:
     Data array with corrected time and coordinates within the specified time period and spatial bounding box.
     '''
     
+    #Chunk sizes are only passed to the cookbook if provided
+    xr_kwargs = {} if chunks is None else {'chunks': chunks}
+
     #If data being accessed is an ice related variable, then apply the following steps
     if ice_data == True:
         #Accessing data
-        vararray = cc.querying.getvar(exp, var, ses, frequency = freq, start_time = start, end_time = end, decode_coords = False)
+        vararray = getvar_cached(exp, var, ses, frequency = freq, start_time = start, end_time = end, decode_coords = False, **xr_kwargs)
         #Accessing corrected coordinate data to update geographical coordinates in the array of interest
-        area_t = cc.querying.getvar(exp, 'area_t', ses, n = 1)
+        area_t = getvar_cached(exp, 'area_t', ses, n = 1)
         #Apply time correction so data appears in the middle (12:00) of the day rather than at the beginning of the day (00:00)
-        vararray['time'] = vararray.time.to_pandas() - dt.timedelta(hours = 12)
+        vararray = vararray.assign_coords(time = vararray.time - np.timedelta64(12, 'h'))
         #Change coordinates so they match ocean dimensions 
         vararray.coords['ni'] = area_t['xt_ocean'].values
         vararray.coords['nj'] = area_t['yt_ocean'].values
         #Rename coordinate variables so they match ocean data
         vararray = vararray.rename(({'ni':'xt_ocean', 'nj':'yt_ocean'}))
-        #Drop coordinates that are no longer needed
-        if len(vararray.coords) > 3:
-            vararray = vararray.drop([i for i in vararray.coords if i not in ['time', 'xt_ocean', 'yt_ocean']])
+        #Drop coordinates that are no longer needed (i.e., all non-dimension coordinates)
+        vararray = vararray.reset_coords(drop = True)
     else:
         #Accessing data
-        vararray = cc.querying.getvar(exp, var, ses, frequency = freq, start_time = start, end_time = end)
+        vararray = getvar_cached(exp, var, ses, frequency = freq, start_time = start, end_time = end, **xr_kwargs)
     #Subsetting data to area of interest
     if vararray.name in ['u', 'v']:
         vararray = vararray.sel(yu_ocean = slice(minlat, maxlat))
@@ -97,8 +130,17 @@ def corrlong(array):
         long_name = 'xt_ocean'
     
     #Apply longitude correction
-    array[long_name] = ((array[long_name] + 180)%360)-180
-    array = array.sortby(array[long_name])
+    lon = ((array[long_name].values + 180)%360)-180
+    #Find position of smallest corrected longitude
+    k = int(np.argmin(lon))
+    lon = np.roll(lon, -k)
+    #If corrected longitudes are a rotation of sorted values, roll data instead of sorting it
+    if np.all(np.diff(lon) > 0):
+        array = array.roll({long_name: -k}, roll_coords = True)
+        array = array.assign_coords({long_name: lon})
+    else:
+        array = array.assign_coords({long_name: ((array[long_name] + 180)%360)-180})
+        array = array.sortby(array[long_name])
     
     return array
 
@@ -114,14 +156,12 @@ def extract_bottom_layer(da):
     Data array with a single depth layer.
     '''
 
-    #Give a value of 1 to all cells containing environmental data in a single time step
-    mask_2d = xr.where(~np.isnan(da.isel(time = 0)), 1, np.nan)
-    #Perform a cumulative sum along depth axis to identify deepest grid cell with environmental data
-    mask_2d = mask_2d.cumsum('st_ocean').where(~np.isnan(da.isel(time = 0)))
-    #Create a mask identifying deepest cells with a value of 1
-    mask_2d = xr.where(mask_2d == mask_2d.max('st_ocean'), 1, np.nan)
-    #Apply mask to original data array
-    da = (mask_2d*da).sum('st_ocean')
+    #Identify all cells missing environmental data in a single time step
+    missing = np.isnan(da.isel(time = 0).transpose('st_ocean', 'yt_ocean', 'xt_ocean').values)
+    #Search depth axis from the bottom up to find index of deepest grid cell with environmental data (i.e., first cell that is not missing)
+    bottom_idx = (missing.shape[0]-1) - np.argmin(missing[::-1], axis = 0)
+    #Extract values for deepest grid cell. Cells without data in any depth (i.e., land) will be empty
+    da = da.isel(st_ocean = xr.DataArray(bottom_idx, dims = ['yt_ocean', 'xt_ocean'])).drop_vars('st_ocean')
     #Rearrange dimensions to match original dataset
     da = da.transpose('time', 'yt_ocean', 'xt_ocean')
     #Returning bottom layer
@@ -129,6 +169,40 @@ def extract_bottom_layer(da):
 
 
 ########
+#Ball Trees built from sea ice edge coordinates are kept in memory, so they can be reused when the edge does not change between time steps
+_ball_tree_cache = OrderedDict()
+_ball_tree_cache_size = 32
+
+#This function returns a Ball Tree for a set of coordinate pairs, reusing a previously built tree if coordinates are identical
+def edge_ball_tree(coords_rad):
+    '''
+    Inputs:
+    coords_rad (np data array) - Coordinate pairs (latitude, longitude) in radians used to build the Ball Tree
+    
+    Output:
+    Ball Tree using haversine distances
+    '''
+    #Identify coordinate pairs by their contents
+    key = hashlib.blake2b(np.ascontiguousarray(coords_rad).tobytes(), digest_size = 16).digest()
+    ball_tree = _ball_tree_cache.get(key)
+    if ball_tree is None:
+        #Set up Ball Tree (nearest neighbour algorithm). Scikit-learn is only loaded when needed
+        from sklearn.neighbors import BallTree
+        ball_tree = BallTree(coords_rad, metric = 'haversine')
+        _ball_tree_cache[key] = ball_tree
+        #Remove least recently used tree if cache is full
+        if len(_ball_tree_cache) > _ball_tree_cache_size:
+            _ball_tree_cache.popitem(last = False)
+    else:
+        #Mark tree as most recently used
+        _ball_tree_cache.move_to_end(key)
+    return ball_tree
+
+
+########
+#Number of grid cells queried at once in Ball Tree searches
+_query_block_size = 8192
+
 #This function calculates distance from each grid cell to its nearest neighbour in a reference data array. Nearest neighbour refers to the search of the point within a predetermined set of points that is located closest (spatially) to a given point.
 def nn_dist(target_da, grid_coords_numpy, **kwargs):
     '''
@@ -138,21 +212,39 @@ def nn_dist(target_da, grid_coords_numpy, **kwargs):
     Optional:
     folder_out (string) - Path to folder where output will be saved
     file_base (string) - Base name to be used to save outputs
+    zarr_store (string) - Path to zarr store where output will be saved. Outputs are appended along the time dimension, so a single store can be used for all time steps. If the time step is already in the store, it is overwritten. An existing store must have been created by this function using the same grid
     
     Output:
     Data array with distance to nearest neighbour
     '''
-    #Getting coordinate pairs for sea ice edge
-    ice_coords = np.vstack([target_da.yt_ocean[target_da.argmax(dim = 'yt_ocean')],
-                            target_da.xt_ocean]).T
-    
-    #Set up Ball Tree (nearest neighbour algorithm).
-    ball_tree = BallTree(np.deg2rad(ice_coords), metric = 'haversine')
-    #The nearest neighbour calculation will give two outputs: distances in radians and indices
-    dist_rad, ind = ball_tree.query(grid_coords_numpy, return_distance = True)
+    #Load reference data once
+    target_np = np.asarray(target_da.values)
+    #Check if there is any reference data and if it varies (e.g., there is no sea ice or all cells are covered by sea ice)
+    no_data = np.isnan(target_np).all()
+    if no_data or (np.nanmin(target_np) == np.nanmax(target_np)):
+        #Maximum values cannot be identified, so Nearest Neighbour search is skipped. If all cells are reference points (values above zero), distance is zero, otherwise distance cannot be calculated
+        fill_value = 0.0 if (not no_data and np.nanmax(target_np) > 0) else np.nan
+        dist_rad = np.full(target_np.size, fill_value)
+    else:
+        #Find index of maximum values along y axis (missing values are ignored)
+        edge_idx = np.nanargmax(target_np, axis = target_da.get_axis_num('yt_ocean'))
+        #Getting coordinate pairs for sea ice edge
+        ice_coords = np.column_stack([target_da.yt_ocean.values[edge_idx.ravel()],
+                                      np.broadcast_to(target_da.xt_ocean.values, edge_idx.shape).ravel()])
+        #Transform coordinate pairs to radians in place
+        np.deg2rad(ice_coords, out = ice_coords)
+
+        #Set up Ball Tree (nearest neighbour algorithm). Trees are reused if the edge has not changed
+        ball_tree = edge_ball_tree(ice_coords)
+        #The nearest neighbour calculation will give two outputs: distances in radians and indices. Grid cells are queried in blocks, so temporary arrays (e.g., indices) remain small
+        dist_rad = np.empty(grid_coords_numpy.shape[0])
+        for s in range(0, grid_coords_numpy.shape[0], _query_block_size):
+            block_dist, ind = ball_tree.query(grid_coords_numpy[s:s+_query_block_size], return_distance = True)
+            dist_rad[s:s+_query_block_size] = block_dist[:, 0]
     #Transform distances from radians to km and changing data to data array
     earth_radius_km = 6371
-    dist_km = xr.DataArray(data = [(dist_rad*earth_radius_km).reshape(target_da.shape)],
+    dist_rad *= earth_radius_km
+    dist_km = xr.DataArray(data = dist_rad.reshape((1, *target_da.shape)),
                            dims = ['time', 'yt_ocean', 'xt_ocean'],
                            coords = {'time': [target_da.time.values],
                                      'yt_ocean': target_da.yt_ocean.values,
@@ -175,10 +267,58 @@ def nn_dist(target_da, grid_coords_numpy, **kwargs):
             dist_km.to_netcdf(file_out)
         else:
             'File name base is needed to save output. Month and year will be added to this string'
+
+    #If path to zarr store provided, then add output to store
+    if 'zarr_store' in kwargs.keys():
+        zarr_store = kwargs.get('zarr_store')
+        if os.path.exists(zarr_store):
+            #Check existing store contains distances for the same grid
+            stored = xr.open_zarr(zarr_store)
+            if ('dist_km' not in stored) or \
+               (not np.array_equal(stored.yt_ocean.values, dist_km.yt_ocean.values)) or \
+               (not np.array_equal(stored.xt_ocean.values, dist_km.xt_ocean.values)):
+                raise ValueError(f'{zarr_store} does not contain distances for the same grid')
+            #Find if time step is already in the store
+            [idx] = np.nonzero(stored.time.values == dist_km.time.values[0])
+            if idx.size > 0:
+                #Overwrite existing time step. Only variables with a time dimension can be written to a region
+                dist_km.to_dataset().drop_vars(['yt_ocean', 'xt_ocean']).to_zarr(zarr_store, 
+                                                region = {'time': slice(idx[0], idx[0]+1)})
+            else:
+                dist_km.to_dataset().to_zarr(zarr_store, append_dim = 'time')
+        else:
+            #Create store with one chunk per time step. Time units are fixed, so time steps appended later are stored correctly regardless of time of day
+            dist_km.to_dataset().to_zarr(zarr_store, mode = 'w', 
+                                         encoding = {'dist_km': {'chunks': dist_km.shape},
+                                                     'time': {'units': 'seconds since 1970-01-01', 'dtype': 'int64'}})
         
     return dist_km
 
 
+########
+#This function loads colour data for Crameri's palettes. A binary copy (.npy) of the palette is saved next to the text file the first time it is loaded, and results are kept in memory for repeated calls
+@functools.lru_cache(maxsize = 64)
+def load_palette(colourLibraryPath, palette):
+    '''
+    Inputs:
+    colourLibraryPath - the file path where the palettes are currently saved.
+    palette - name of the palette to be loaded.
+    
+    Outputs:
+    Read only numpy array with RGB values for the palette
+    '''
+    npy_path = os.path.join(colourLibraryPath, palette, (palette + '.npy'))
+    if not os.path.exists(npy_path):
+        cm_data = np.loadtxt(os.path.join(colourLibraryPath, palette, (palette + '.txt')))
+        #Save binary copy if folder can be written to, otherwise use data loaded from text file
+        try:
+            np.save(npy_path, cm_data)
+        except OSError:
+            cm_data.setflags(write = False)
+            return cm_data
+    return np.load(npy_path, mmap_mode = 'r')
+
+
 ########
 #This function creates a colour palette using Crameri's palettes (Crameri, F. (2018), Scientific colour-maps, Zenodo, doi:10.5281/zenodo.1243862)
 def colourMaps(colourLibraryPath, palette, rev = True):
@@ -195,8 +335,8 @@ def colourMaps(colourLibraryPath, palette, rev = True):
     from matplotlib.colors import LinearSegmentedColormap
     from matplotlib.colors import ListedColormap
 
-    #Set path where the scientific library is found
-    cm_data = np.loadtxt(os.path.join(colourLibraryPath, palette, (palette + '.txt')))
+    #Load colour data from the scientific library
+    cm_data = load_palette(colourLibraryPath, palette)
     #Create a colour map based on 'palette' argument
     pal_map_adv = LinearSegmentedColormap.from_list(palette, cm_data)
         
@@ -207,30 +347,137 @@ def colourMaps(colourLibraryPath, palette, rev = True):
         return pal_map_adv
 
 
+########
+#Target grid indexed by coordinates and month. It is kept in memory so the index is only built once when multiple files are loaded with the same target grid
+_coords_index_cache = {}
+
+#This function returns a key based on the contents of a data frame, so changes made in place are detected
+def frame_key(df):
+    '''
+    Inputs:
+    df - data frame to be used to create key
+    
+    Outputs:
+    String with digest of column names and values in data frame
+    '''
+    h = hashlib.blake2b(repr(list(df.columns)).encode(), digest_size = 16)
+    h.update(pd.util.hash_pandas_object(df, index = False).values.tobytes())
+    return h.hexdigest()
+
+#This function returns the target grid indexed by coordinates and month
+def index_coords(df_coords):
+    '''
+    Inputs:
+    df_coords - target grid to be indexed. It must contain xt_ocean, yt_ocean and month columns. The indexed grid is reused while the same data frame is used, so it must not be modified in place (use a modified copy instead)
+    
+    Outputs:
+    Data frame with target grid indexed by xt_ocean, yt_ocean and month
+    '''
+    #Target grid is matched by identity and shape, so it is not hashed for every file
+    if (_coords_index_cache.get('coords') is not df_coords) or (_coords_index_cache.get('shape') != df_coords.shape):
+        _coords_index_cache.update(coords = df_coords, shape = df_coords.shape, 
+                                   indexed = df_coords.set_index(['xt_ocean', 'yt_ocean', 'month']))
+    return _coords_index_cache['indexed']
+
+
+########
+#DuckDB connection with target grid registered as a table. It is kept in memory so the target grid is only registered once
+_duckdb_cache = {}
+
+#This function adds SDM predictions to the target grid using a DuckDB left join (multi-threaded)
+def join_duckdb(df_coords, df):
+    '''
+    Inputs:
+    df_coords - target grid. It must contain xt_ocean, yt_ocean and month columns
+    df - data frame with SDM predictions (pred and model columns)
+    
+    Outputs:
+    Data frame with target grid and SDM predictions in the same row order as df_coords
+    '''
+    #DuckDB is optional, so it is only loaded if this function is used
+    import duckdb
+    #Key is based on contents, so target grid is registered again if it is modified in place
+    key = frame_key(df_coords)
+    if _duckdb_cache.get('key') != key:
+        #Close connection used for previous target grid
+        if 'con' in _duckdb_cache:
+            _duckdb_cache['con'].close()
+        con = duckdb.connect()
+        #Row number is used to return rows in the same order as target grid
+        coords = df_coords.reset_index(drop = True).assign(row_order = np.arange(len(df_coords)))
+        con.register('coords', coords)
+        _duckdb_cache.update(key = key, registered = coords, con = con)
+    con = _duckdb_cache['con']
+    con.register('preds', df)
+    df = con.execute('''SELECT c.*, p.pred, p.model FROM coords c 
+                        LEFT JOIN preds p USING (xt_ocean, yt_ocean, month) 
+                        ORDER BY c.row_order''').fetch_df()
+    con.unregister('preds')
+    #Categories are returned as ordered (DuckDB ENUM), so they are changed back to unordered as in df
+    df['model'] = df.model.cat.as_unordered()
+    return df.drop(columns = 'row_order')
+
+
 ########
 #This function creates a single data frame with SDM outputs that can be used to create a data array for plotting
-def df_ready(file_path, model, df_coords):
+def df_ready(file_path, model, df_coords, **kwargs):
     '''
     Inputs:
     file_path - file path to data location
     model - name of the SDM algorithm used to create outputs
     df_coords - target grid to be used to create data frame
+    Optional:
+    engine (string) - Library used to add predictions to target grid: 'pandas' (default) or 'duckdb'. DuckDB must be installed to use this option
+    coords_idx (data frame) - Target grid indexed by xt_ocean, yt_ocean and month (output of index_coords). If provided, target grid is not indexed again
     
     Outputs:
     Data frame containing SDM predictions
     '''
-    #Load csv file
-    df = pd.read_csv(file_path)
-    #Add SDM algorithm to data frame
-    df['model'] = model
-    #Keep relevant columns 
-    df = df[['yt_ocean', 'xt_ocean', 'pred', 'month', 'model']]
+    #Load relevant columns from csv file
+    df = pd.read_csv(file_path, usecols = ['yt_ocean', 'xt_ocean', 'pred', 'month'])
+    #Add SDM algorithm to data frame. A single category is used as the name is the same for all rows
+    df['model'] = pd.Categorical.from_codes(np.zeros(len(df), dtype = np.int8), categories = [model])
     #Add coordinates from target grid
-    df = df_coords.merge(df, on = ['xt_ocean', 'yt_ocean', 'month'], how = 'left')
+    if kwargs.get('engine', 'pandas') == 'duckdb':
+        df = join_duckdb(df_coords, df)
+    else:
+        #Using indexed target grid
+        coords_idx = kwargs.get('coords_idx')
+        if coords_idx is None:
+            coords_idx = index_coords(df_coords)
+        df = coords_idx.join(df.set_index(['xt_ocean', 'yt_ocean', 'month']), how = 'left')
+        #Keep column order of target grid
+        df = df.reset_index()[[*df_coords.columns, 'pred', 'model']]
     #Return data frame
     return df
 
 
+#This function applies df_ready to multiple files in parallel
+def df_ready_many(file_paths, models, df_coords, n_jobs = -1, **kwargs):
+    '''
+    Inputs:
+    file_paths - list of file paths to data location
+    models - list with names of the SDM algorithm used to create outputs in each file
+    df_coords - target grid to be used to create data frames
+    n_jobs - number of files processed at the same time. Default is -1, which uses all available CPUs
+    Optional:
+    Any optional arguments accepted by df_ready (e.g., engine)
+    
+    Outputs:
+    List of data frames containing SDM predictions in the same order as file_paths
+    '''
+    #Large arrays in the target grid are memory mapped by joblib, so they are shared with all workers instead of being copied for each file
+    #Target grid is indexed once, so workers do not index it again for each file
+    if kwargs.get('engine', 'pandas') != 'duckdb' and 'coords_idx' not in kwargs:
+        kwargs['coords_idx'] = index_coords(df_coords)
+    list_df = Parallel(n_jobs = n_jobs)(delayed(df_ready)(f, m, df_coords, **kwargs) for f, m in zip(file_paths, models))
+    #Return list of data frames
+    return list_df
+
+
+#Month names (index 0 is empty so months can be used as indices). Computed once so locale lookups are not repeated
+_month_names = tuple(calendar.month_name)
+
 #This function creates a single dataset with SDM outputs from a list of data frames
 def ds_sdm(list_df, grid_sample, weights, weights_col):
     '''
@@ -243,51 +490,40 @@ def ds_sdm(list_df, grid_sample, weights, weights_col):
     Outputs:
     Data frame containing SDM predictions and weighted ensemble mean
     '''
-    #Create a single data frame with all predictions
-    df = pd.concat(list_df)
-
-    #Initialising empty dictionary to create dataset
-    ds = {}
-
-    #Looping through each month
-    for m in df.month.unique():
-        #Turn data frames into data arrays
-        mth = df[df.month == m]
-        mods = mth.model.dropna().unique()
-        mth_da = xr.DataArray(data = mth.pred.values.reshape((len(mods),*grid_sample.shape)),
-                              dims = ['model', 'yt_ocean', 'xt_ocean'],
-                              coords = {'model': mods,
-                                        'xt_ocean': grid_sample.xt_ocean.values,
-                                        'yt_ocean': grid_sample.yt_ocean.values})
-        
-        #Calculate weighted ensemble
-        ensemble = []
-        #Loop through all models
-        for mod in mods:
-            #Extract model data 
-            da_mod = mth_da.sel(model = mod)
-            #Extract weights for model
-            [w] = weights[weights_col][weights.model == mod].to_list()
-            #Multiply model data by weight
-            da_mod = da_mod*w
-            #Attach weighted data to ensemble variable
-            ensemble.append(da_mod)
-        
-        #Concatenate all data frames into single variable, add them up to get ensemble mean
-        ensemble = xr.concat(ensemble, dim = 'model').sum('model').expand_dims({'model': ['Ensemble']})
-        #Apply land mask from sample grid
-        ensemble = xr.where(~np.isnan(grid_sample), ensemble, np.nan)
-        
-        #Add ensemble to all other models
-        mth_da = xr.concat([mth_da, ensemble], dim = 'model')
-
-        #Get name of month based on month digits
-        mth_name = calendar.month_name[m]
-        #Add to empty list to be used to create dataset
-        ds[mth_name] = mth_da
-
-    #Creating datasets
-    ds = xr.Dataset(ds)
+    #Create a single data frame with all predictions. Grid cells without predictions have no model name, so the SDM algorithm of each data frame is used instead
+    df = pd.concat([d.assign(model = d.model.dropna().unique()[0]) for d in list_df])
+    #Keep SDM algorithms in the order they were provided
+    mods = df.model.unique()
+
+    #Check weights are available for all SDM algorithms
+    missing_weights = set(mods) - set(weights.model)
+    if missing_weights:
+        raise ValueError(f'No weights provided for models: {sorted(missing_weights)}')
+    #Multiply predictions by the weights for each model
+    df['weighted'] = df.pred*df.model.map(weights.set_index('model')[weights_col])
+    #Add up weighted predictions for each grid cell and month to get ensemble mean
+    ensemble = df.groupby(['month', 'yt_ocean', 'xt_ocean']).weighted.sum().to_frame('pred')
+    ensemble['model'] = 'Ensemble'
+
+    #Turn model and ensemble predictions into a single data array
+    da = pd.concat([df.set_index(['month', 'yt_ocean', 'xt_ocean'])[['pred', 'model']], ensemble])
+    da = da.set_index('model', append = True).pred.to_xarray()
+    #Keep original order of SDM algorithms
+    da = da.reindex(model = [*mods, 'Ensemble']).transpose('month', 'model', 'yt_ocean', 'xt_ocean')
+    #Coordinates in data array are sorted in ascending order, so they are rearranged to match the order in the sample grid before using its coordinates
+    for dim in ['yt_ocean', 'xt_ocean']:
+        grid_coord = grid_sample[dim].values
+        if da.sizes[dim] != grid_coord.size:
+            raise ValueError(f'{dim} in data frames does not match sample grid')
+        da = da.isel({dim: np.argsort(np.argsort(grid_coord, kind = 'stable'), kind = 'stable')})
+        da = da.assign_coords({dim: grid_coord})
+    #Apply land mask from sample grid to ensemble
+    land = np.isnan(grid_sample.transpose('yt_ocean', 'xt_ocean').values)
+    da.loc[{'model': 'Ensemble'}] = da.sel(model = 'Ensemble').where(~land)
+
+    #Creating datasets with one variable per month
+    ds = da.to_dataset(dim = 'month')
+    ds = ds.rename({m: _month_names[m] for m in da.month.values})
     
     #Return dataset
     return ds
@@ -397,6 +633,35 @@ def krill_growth(temp_df, phyto_df, **kwargs):
     #Return monthly growth and GGP
     return mth_gp, ggp
 
+#Transformers are kept in memory so they are only created once for each pair of CRSs
+@functools.lru_cache(maxsize = 16)
+def get_transformer(source_crs, target_crs, always_xy = True):
+    '''
+    Inputs:
+    source_crs - original CRS. Should be provided as a string in the form of 'epsg:4326'.
+    target_crs - target CRS. Should be provided as a string in the form of 'epsg:4326'.
+    always_xy - Boolean. If True, coordinates are given and returned in x, y (longitude, latitude) order. Default is True.
+
+    Output:
+    pyproj Transformer
+    '''
+    return Transformer.from_crs(source_crs, target_crs, always_xy = always_xy)
+
+#Transform coordinates between CRSs. All coordinates are transformed in a single call, so avoid calling this function for each point
+def vec_transform(source_crs, target_crs, xs, ys, always_xy = True):
+    '''
+    Inputs:
+    source_crs - original CRS for coordinates. Should be provided as a string in the form of 'epsg:4326'.
+    target_crs - CRS to which coordinates will be transformed. Should be provided as a string in the form of 'epsg:4326'.
+    xs - array with x coordinates (or longitude)
+    ys - array with y coordinates (or latitude)
+    always_xy - Boolean. If True, coordinates are given and returned in x, y (longitude, latitude) order. If False, axis order defined by each CRS is used. Default is True.
+    
+    Output:
+    Two arrays with transformed coordinates
+    '''
+    return get_transformer(source_crs, target_crs, always_xy).transform(np.asarray(xs), np.asarray(ys))
+
 #Calculate the lat-lon coordinates from a dataset in source_crs - Function by Scott Wales
 def calculate_latlon_coords(da, source_crs, target_crs):
     '''
@@ -409,11 +674,8 @@ def calculate_latlon_coords(da, source_crs, target_crs):
     # Convert the 1d coordinates to 2d arrays covering the whole grid
     X, Y = np.meshgrid(da.x, da.y)
     
-    # Use proj to create a transformation from the source coordinates to lat/lon
-    trans = Transformer.from_crs(source_crs, target_crs)
-    
-    # Convert the 2d coordinates from the source to the target values
-    lat, lon = trans.transform(X, Y)
+    # Convert the 2d coordinates from the source to the target values using proj (axis order defined by CRS)
+    lat, lon = vec_transform(source_crs, target_crs, X, Y, always_xy = False)
     
     # Add the coordinates to the dataset
     da.coords['lat'] = (('y','x'), lat)